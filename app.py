@@ -1,8 +1,29 @@
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 from flask import Flask, jsonify, request
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
-import requests
-from utils import convert_currency, fetchCharts, getIntervalFromRange, getPortfolioDoc, getPortfolioDocRef, getPortfolioStocksValuesUsingQuantity, fetchQuoteStocks, getReferenceCurrency
+from utils import (
+    API_URL,
+    HISTORY_FIELDS,
+    HOLDINGS_FIELDS,
+    HTTP,
+    HTTP_TIMEOUT,
+    convertMany,
+    convert_currency,
+    fetchCharts,
+    fetchQuoteStocks,
+    getHoldingsValue,
+    getIntervalFromRange,
+    getLastHistoryDate,
+    getPortfolioBundle,
+    getPortfolioDoc,
+    getPortfolioDocRef,
+    getPortfolioStocksValuesUsingQuantity,
+    getReferenceCurrency,
+    getTotalShares,
+    invalidatePortfolioDoc,
+    todayIso,
+)
 import firebase_admin
 from firebase_admin import credentials, firestore
 from cache import cache
@@ -11,6 +32,13 @@ import os
 import logging
 from logging.handlers import RotatingFileHandler
 from functools import wraps
+import uuid
+import hashlib
+import itertools
+import numpy as np
+import pandas as pd
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables
 load_dotenv(".env")
@@ -38,7 +66,22 @@ def setup_logging(app):
         app.logger.setLevel(logging.INFO)
         app.logger.info('Portfolio API startup')
 
+# Serialize responses with orjson, large chart payloads are mostly float arrays
+class ORJSONProvider(JSONProvider):
+    options = orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.options), mimetype="application/json")
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 
 # Security headers
 @app.after_request
@@ -58,11 +101,19 @@ CORS(app, resources={
     }
 })
 
-# Cache configuration
-cache.init_app(app, config={
-    'CACHE_TYPE': 'SimpleCache',
-    'CACHE_DEFAULT_TIMEOUT': 900
-})
+# Cache configuration, shared across gunicorn workers through Redis when configured
+REDIS_URL = os.getenv('REDIS_URL')
+if REDIS_URL:
+    cache.init_app(app, config={
+        'CACHE_TYPE': 'RedisCache',
+        'CACHE_REDIS_URL': REDIS_URL,
+        'CACHE_DEFAULT_TIMEOUT': 900
+    })
+else:
+    cache.init_app(app, config={
+        'CACHE_TYPE': 'SimpleCache',
+        'CACHE_DEFAULT_TIMEOUT': 900
+    })
 
 # Firebase initialization with error handling
 firebase_creds = {
@@ -83,11 +134,31 @@ cred = credentials.Certificate(firebase_creds)
 firebase_admin.initialize_app(cred)
 db = firestore.client()
 
-# Get API config from environment
-API_URL = os.getenv('API_URL')
-API_HEADERS = {
-    'X-API-KEY': os.getenv('API_KEY')
-}
+# Shared pool for overlapping independent Firestore/API calls
+EXECUTOR = ThreadPoolExecutor(max_workers=16)
+
+# Response caching for GET analytics endpoints
+def ownerCacheKey():
+    """Cache key for the current request, scoped to the owner's cache generation"""
+    owner_id = request.args.get("owner_id")
+    generation = cache.get(f"generation/{owner_id}") or 0
+    query = "&".join(f"{key}={value}" for key, value in sorted(request.args.items(multi=True)))
+    return f"view/{request.path}?{query}#{generation}"
+
+def currencyCacheKey():
+    """Cache key for responses that only vary with the owner's reference currency"""
+    owner_id = request.args.get("owner_id")
+    currency = getReferenceCurrency(db, owner_id) if owner_id else None
+    return f"view/{request.path}#{currency}"
+
+def invalidateOwnerCache(owner_id):
+    """Drop every cached response and snapshot for an owner after a portfolio write"""
+    # The write is already committed, a cache outage must not turn it into an error the client retries
+    try:
+        invalidatePortfolioDoc(db, owner_id)
+        cache.set(f"generation/{owner_id}", uuid.uuid4().hex, timeout=0)
+    except Exception as e:
+        app.logger.warning("Error invalidating cache for %s: %s", owner_id, e)
 
 # Error handlers
 @app.errorhandler(400)
@@ -118,6 +189,17 @@ def validate_owner_id(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Conditional GET for polled endpoints, sits above cache.cached so a 304 is never cached
+def conditional(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        response = app.make_response(f(*args, **kwargs))
+        if response.status_code == 200:
+            response.set_etag(hashlib.blake2b(response.get_data(), digest_size=16).hexdigest())
+            response.make_conditional(request)
+        return response
+    return decorated_function
+
 # Health check endpoint
 @app.route('/health')
 def health_check():
@@ -145,10 +227,12 @@ def readiness_check():
 
 # API Routes
 @app.route('/marketSummary/<region>')
+@cache.cached(timeout=30, key_prefix=currencyCacheKey)
 def getMarketSummary(region):
     owner_id = request.args.get("owner_id")
+    currency_future = EXECUTOR.submit(getReferenceCurrency, db, owner_id)
 
-    trending_response = requests.get(f"{API_URL}/v1/finance/trending/{region}", headers=API_HEADERS)
+    trending_response = HTTP.get(f"{API_URL}/v1/finance/trending/{region}", timeout=HTTP_TIMEOUT)
     trending_data = trending_response.json()
 
     if "finance" not in trending_data or not trending_data["finance"]["result"]:
@@ -159,25 +243,26 @@ def getMarketSummary(region):
 
     filtered_stocks = fetchQuoteStocks(symbols_str)
 
-    reference_currency = getReferenceCurrency(db, owner_id)
+    reference_currency = currency_future.result()
     if reference_currency != "USD":
-        for stock in filtered_stocks:
-            if "price" in stock:
-                stock["price"] = convert_currency(stock["price"], "USD", reference_currency)
+        prices = convertMany([stock["price"] for stock in filtered_stocks], "USD", reference_currency)
+        for stock, price in zip(filtered_stocks, prices):
+            stock["price"] = price
             stock["currency"] = reference_currency
 
     return jsonify(filtered_stocks)
 
 @app.route('/portfolio/stocks/chart')
 @validate_owner_id
+@conditional
+@cache.cached(timeout=30, key_prefix=ownerCacheKey)
 def getPortfolioStocksCharts():
     owner_id = request.args.get("owner_id")
     
     if not owner_id:
         return jsonify({"error": "Missing owner_id"}), 400
 
-    reference_currency = getReferenceCurrency(db, owner_id)
-    doc = getPortfolioDoc(db, owner_id)
+    reference_currency, doc = getPortfolioBundle(db, owner_id, HOLDINGS_FIELDS)
     if not doc:
         return jsonify([])
 
@@ -192,20 +277,23 @@ def getPortfolioStocksCharts():
     charts = fetchCharts(symbols_str, interval, range_param)
 
     if reference_currency != "USD":
-        for symbol, data in charts.items():
-            for key in ['close', 'open', 'high', 'low']:
-                if key in data:
-                    data[key] = [convert_currency(price, 'USD', reference_currency) for price in data[key]]
-            if 'chartPreviousClose' in data:
-                data['chartPreviousClose'] = convert_currency(data['chartPreviousClose'], 'USD', reference_currency)
-            data['currency'] = reference_currency
+        # Only the close series is returned, convert all of them in one rounding pass
+        series = [data["close"] for data in charts.values() if "close" in data]
+        converted = iter(convertMany(itertools.chain.from_iterable(series), 'USD', reference_currency))
+        for data in charts.values():
+            if "close" in data:
+                data["close"] = list(itertools.islice(converted, len(data["close"])))
 
     response = []
+    # Symbols charted over the same range usually share one timestamp axis, format it once
+    formatted_dates = {}
     for symbol, data in charts.items():
-        timestamps = data.get("timestamp", [])
+        timestamps = tuple(data.get("timestamp", []))
         close_prices = data.get("close", [])
 
-        date_strings = [datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S") for ts in timestamps]
+        if timestamps not in formatted_dates:
+            formatted_dates[timestamps] = pd.to_datetime(timestamps, unit='s', utc=True).strftime("%Y-%m-%d %H:%M:%S").tolist()
+        date_strings = formatted_dates[timestamps]
 
         response.append({
             "symbol": symbol,
@@ -213,11 +301,13 @@ def getPortfolioStocksCharts():
             "close": close_prices
         })
 
-    print(response)
+    app.logger.debug("charts response len=%d", len(response))
     return jsonify(response)
 
 @app.route('/portfolio/value/chart')
 @validate_owner_id
+@conditional
+@cache.cached(timeout=30, key_prefix=ownerCacheKey)
 def getPortfolioChart():
     owner_id = request.args.get("owner_id")
     range_filter = request.args.get("range", "1w")
@@ -225,14 +315,12 @@ def getPortfolioChart():
     if not owner_id:
         return jsonify({"error": "Missing owner_id"}), 400
 
-    reference_currency = getReferenceCurrency(db, owner_id)
-    doc = getPortfolioDoc(db, owner_id)
+    reference_currency, doc = getPortfolioBundle(db, owner_id, HISTORY_FIELDS)
     if not doc:
         return jsonify({"history": {}})
 
     timesAndValues = doc.get("history", {})
 
-    history_filtered = {}
     today = datetime.now(timezone.utc).date()
 
     if range_filter == "1w":
@@ -244,15 +332,15 @@ def getPortfolioChart():
     else:
         start_date = None 
 
-    for date_str, value in timesAndValues.items():
-        date_obj = datetime.strptime(date_str, "%Y-%m-%d").date()
-        if start_date is None or date_obj >= start_date:
-            history_filtered[date_str] = value
+    if start_date is None:
+        history_filtered = dict(timesAndValues)
+    else:
+        start_str = start_date.isoformat()
+        history_filtered = {date_str: value for date_str, value in timesAndValues.items() if date_str >= start_str}
 
     if reference_currency != "USD":
-        converted_history = {}
-        for date, value in history_filtered.items():
-            converted_history[date] = convert_currency(value, 'USD', reference_currency)
+        converted_values = convertMany(history_filtered.values(), 'USD', reference_currency)
+        converted_history = dict(zip(history_filtered.keys(), converted_values))
         return jsonify({"history": converted_history})
 
     return jsonify({"history": history_filtered})
@@ -265,17 +353,16 @@ def getPortfolioValue():
     if not owner_id:
         return jsonify({"error": "Missing owner_id"}), 400
     
-    reference_currency = getReferenceCurrency(db, owner_id)
-    doc=getPortfolioDoc(db, owner_id)
+    today_str = todayIso()
+    yesterday_str = (date.fromisoformat(today_str) - timedelta(days=1)).isoformat()
+
+    # Shares the cached snapshot with the overview endpoint, polled just as often
+    reference_currency, doc = getPortfolioBundle(db, owner_id)
     if not doc:
         return {}
     
     stocks = doc.get("stocks", {})
     stocks_count = len(stocks)
-    today = datetime.now()
-    yesterday = today - timedelta(days=1)
-    today_str = today.strftime("%Y-%m-%d")
-    yesterday_str = yesterday.strftime("%Y-%m-%d")
     history = doc.get("history", {})
     yesterday_history_value = history.get(yesterday_str, 0)
     today_history_value = history.get(today_str, 0)
@@ -284,15 +371,12 @@ def getPortfolioValue():
         symbols_str = ",".join(stocks.keys())
         try:
             stock_data = fetchQuoteStocks(symbols_str)
-            for stock in stock_data:
-                symbol = stock['symbol']
-                current_price = stock['price']  # USD
-                quantity = stocks.get(symbol, 0)
-                today_history_value += current_price * quantity
+            today_history_value = getHoldingsValue(stock_data, stocks)  # USD
             docRef = getPortfolioDocRef(db, owner_id)
-            docRef.update({f"history.{today_str}": today_history_value})
+            docRef.update({f"history.{today_str}": today_history_value, "last_history_date": today_str})
+            invalidateOwnerCache(owner_id)
         except Exception as e:
-            print(f"Error calculating today's value: {e}")
+            app.logger.warning("Error calculating today's value: %s", e)
 
     if yesterday_history_value == 0:
         change_percentage = "0.00%"
@@ -320,8 +404,7 @@ def getPortfolioStocksValues():
     if not owner_id:
         return jsonify({"error": "Missing owner_id"}), 400
 
-    reference_currency = getReferenceCurrency(db, owner_id)
-    doc=getPortfolioDoc(db, owner_id)
+    reference_currency, doc = getPortfolioBundle(db, owner_id, HOLDINGS_FIELDS)
     if not doc:
         return {}
     stocksAndQuantities = doc.get("stocks")
@@ -330,11 +413,9 @@ def getPortfolioStocksValues():
     
     # Convert values to requested currency
     if reference_currency != "USD":
-        for stock in data:
-            if 'value' in stock:
-                stock['value'] = convert_currency(stock['value'], 'USD', reference_currency)
-            if 'price' in stock:
-                stock['price'] = convert_currency(stock['price'], 'USD', reference_currency)
+        values = convertMany([stock['value'] for stock in data], 'USD', reference_currency)
+        for stock, value in zip(data, values):
+            stock['value'] = value
             stock['currency'] = reference_currency
 
 
@@ -352,26 +433,32 @@ def getPortfolioStocksDistribution():
     stocksAndQuantities = doc.get("stocks")
     symbols_str = ",".join(stocksAndQuantities.keys())
     data = getPortfolioStocksValuesUsingQuantity(symbols_str, stocksAndQuantities)
-    today = datetime.now()
-    today_str = today.strftime("%Y-%m-%d")
+    today_str = todayIso()
     valuePortfolio = doc.get("history").get(today_str, 0)
 
+    values = np.fromiter((d['value'] for d in data), dtype=np.float64, count=len(data))
+    # Today's value is 0 after selling everything, or before it has been recorded
+    if valuePortfolio == 0:
+        percentages = [0.0] * len(data)
+    else:
+        percentages = (values / valuePortfolio * 100).tolist()
+
     response = []
-    for d in data:
-        response.append({"symbol": d['symbol'], "value": f"{d['value'] / valuePortfolio * 100}"})
+    for d, percentage in zip(data, percentages):
+        response.append({"symbol": d['symbol'], "value": f"{percentage}"})
 
     return jsonify(response)
 
 @app.route('/portfolio/stocks')
 @validate_owner_id
+@cache.cached(timeout=30, key_prefix=ownerCacheKey)
 def getPortfolioStocks():
     owner_id = request.args.get("owner_id")
     
     if not owner_id:
         return jsonify({"error": "Missing owner_id"}), 400
 
-    reference_currency = getReferenceCurrency(db, owner_id)
-    doc=getPortfolioDoc(db, owner_id)
+    reference_currency, doc = getPortfolioBundle(db, owner_id, HOLDINGS_FIELDS)
     if not doc:
         return []
     stocksAndQuantities = doc.get("stocks")
@@ -384,14 +471,13 @@ def getPortfolioStocks():
     
     data = fetch_data(symbols_str, "1d", "1d")
     response = []
+    converted_prices = convertMany([d['close'][0] * stocksAndQuantities[symbol] for symbol, d in data.items()], 'USD', reference_currency)
     
-    for symbol, d in data.items():
+    for (symbol, d), converted_price in zip(data.items(), converted_prices):
         current_price = d['close'][0]
         prev_close = d['chartPreviousClose']
         change_percent = ((current_price - prev_close) / prev_close) * 100
         change_str = f"{change_percent:+.2f}%"
-
-        converted_price = convert_currency(current_price * stocksAndQuantities[symbol], 'USD', reference_currency)
         
         response.append({
             "symbol": symbol,
@@ -404,49 +490,43 @@ def getPortfolioStocks():
 
 @app.route('/portfolio/overview')
 @validate_owner_id
+@conditional
+@cache.cached(timeout=30, key_prefix=ownerCacheKey)
 def getPortfolioOverview():
     owner_id = request.args.get("owner_id")
     
     if not owner_id:
         return jsonify({"error": "Missing owner_id"}), 400
-    reference_currency = getReferenceCurrency(db, owner_id)
-    doc=getPortfolioDoc(db, owner_id)
+    reference_currency, doc = getPortfolioBundle(db, owner_id)
     if not doc:
-        print("No document found!")
+        app.logger.debug("No document found!")
         return {}
     
     cost = doc.get("cost", 0)
     history = doc.get("history", {})
     stocks = doc.get("stocks", {})
-    today_str = datetime.now().strftime("%Y-%m-%d")
+    today_str = todayIso()
 
     value = 0
     if stocks:
         symbols_str = ",".join(stocks.keys())
         try:
             stock_data = fetchQuoteStocks(symbols_str)
-            
-            for stock in stock_data:
-                symbol = stock['symbol']
-                current_price = stock['price']  # USD
-                quantity = stocks.get(symbol, 0)
-                stock_value = current_price * quantity
-                value += stock_value
+            value = getHoldingsValue(stock_data, stocks)  # USD
 
             if today_str not in history or history[today_str] == 0:
                 docRef = getPortfolioDocRef(db, owner_id)
-                docRef.update({f"history.{today_str}": value})
+                docRef.update({f"history.{today_str}": value, "last_history_date": today_str})
+                invalidateOwnerCache(owner_id)
         except Exception as e:
-            print(f"Error calculating portfolio value: {e}")
+            app.logger.warning("Error calculating portfolio value: %s", e)
             if today_str in history:
                 value = history[today_str]
             elif history:
-                last_date_str = max(history.keys(), key=lambda d: datetime.strptime(d, "%Y-%m-%d"))
+                last_date_str = getLastHistoryDate(doc)
                 value = history[last_date_str]
     
-    number_of_stocks = 0
-    for s in stocks.values():
-        number_of_stocks += s
+    number_of_stocks = getTotalShares(doc)
 
     change_percentage = ((value - cost) / cost * 100) if cost != 0 else 0
     profit = value - cost
@@ -465,6 +545,135 @@ def getPortfolioOverview():
     }
     return jsonify(result)
     
+def quotePrice(symbol):
+    """USD price of a symbol, or None when it can't be quoted"""
+    quote = fetchQuoteStocks(symbol)
+    return quote[0]['price'] if quote else None
+
+# Trades read and write the portfolio inside a transaction so concurrent trades can't lose updates.
+# The price is quoted before the transaction (None for an unknown symbol) so the document is never
+# locked across a Yahoo round-trip.
+# Both return an (error message, status) pair on rejection and the traded USD value on success.
+@firestore.transactional
+def applySell(transaction, doc, symbol, quantity, price):
+    doc_data = doc.get(transaction=transaction)
+
+    if not doc_data.exists:
+        return ("Portfolio not found. Please buy stocks first.", 404), None
+
+    docData = doc_data.to_dict()
+    ownedQuantity = docData.get("stocks", {}).get(symbol, 0)
+
+    if ownedQuantity < quantity:
+        return ("Not enough stocks to sell", 400), None
+
+    if price is None:
+        return ("Invalid stock symbol", 400), None
+
+    history = docData.get("history", {})
+    today_str = todayIso()
+    yesterdayValueNotAdded = 0
+
+    if today_str not in history and history:
+        last_date_str = getLastHistoryDate(docData)
+        yesterdayValueNotAdded = history[last_date_str]
+
+    # Written back as a plain value so portfolios created before the field existed pick it up
+    total_stocks_remaining = getTotalShares(docData) - quantity
+
+    # Get current stocks and update manually
+    current_stocks = docData.get("stocks", {}).copy()
+    
+    if ownedQuantity == quantity:
+        # Remove the stock entirely
+        del current_stocks[symbol]
+        
+        if total_stocks_remaining == 0:
+            transaction.update(doc, {
+                "stocks": current_stocks,
+                "total_shares": 0,
+                "cost": 0,
+                f"history.{today_str}": 0,
+                "last_history_date": today_str
+            })
+        else:
+            transaction.update(doc, {
+                "stocks": current_stocks,
+                "total_shares": total_stocks_remaining,
+                "cost": firestore.Increment(price * quantity * -1),
+                f"history.{today_str}": firestore.Increment(price * quantity * -1 + yesterdayValueNotAdded),
+                "last_history_date": today_str
+            })
+    else:
+        # Decrease the quantity
+        current_stocks[symbol] = ownedQuantity - quantity
+        transaction.update(doc, {
+            "stocks": current_stocks,
+            "total_shares": total_stocks_remaining,
+            "cost": firestore.Increment(price * quantity * -1),
+            f"history.{today_str}": firestore.Increment(price * quantity * -1 + yesterdayValueNotAdded),
+            "last_history_date": today_str
+        })
+
+    return None, price * quantity
+
+@firestore.transactional
+def applyBuy(transaction, doc, symbol, quantity, price):
+    doc_data = doc.get(transaction=transaction)
+    if doc_data.exists:
+        docData = doc_data.to_dict()
+    else:
+        # Initialize portfolio if it doesn't exist
+        docData = {
+            "stocks": {},
+            "total_shares": 0,
+            "cost": 0,
+            "history": {}
+        }
+
+    stocksNumber = len(docData.get("stocks", {}))
+
+    if stocksNumber >= 10:
+        return ("Maximum number of different stocks reached (10)", 400), None
+    
+    if price is None:
+        return ("Wrong stock", 400), None
+    
+    history = docData.get("history", {})
+    today_str = todayIso()
+    
+    # Calculate the value to add to today's history
+    yesterdayValueNotAdded = 0
+    if today_str not in history:
+        if history:
+            # Get the most recent history value
+            last_date_str = getLastHistoryDate(docData)
+            yesterdayValueNotAdded = history[last_date_str]
+            app.logger.debug("Yesterday's value to add: %s from %s", yesterdayValueNotAdded, last_date_str)
+        else:
+            app.logger.debug("No history found, starting fresh")
+    else:
+        app.logger.debug("Today already has history value: %s", history[today_str])
+    
+    stock_value = price * quantity
+    history_increment = stock_value + yesterdayValueNotAdded
+
+    # Get current stocks and update manually
+    current_stocks = docData.get("stocks", {}).copy()
+    current_stocks[symbol] = current_stocks.get(symbol, 0) + quantity
+
+    if not doc_data.exists:
+        transaction.set(doc, docData)
+    transaction.update(doc, {
+        "stocks": current_stocks,
+        "total_shares": getTotalShares(docData) + quantity,
+        "cost": firestore.Increment(stock_value),
+        f"history.{today_str}": firestore.Increment(history_increment),
+        "last_history_date": today_str
+    })
+
+    return None, stock_value
+
 @app.route('/portfolio/sell', methods=['POST'])
 @validate_owner_id
 def sellStock():
@@ -474,14 +683,6 @@ def sellStock():
         if not owner_id:
             return jsonify({"error": "Missing owner_id"}), 400
         
-        reference_currency = getReferenceCurrency(db, owner_id)
-
-        doc = getPortfolioDocRef(db, owner_id)
-        doc_data = doc.get()
-
-        if not doc_data.exists:
-            return jsonify({"error": "Portfolio not found. Please buy stocks first."}), 404
-
         data = request.get_json()        
         if not data:
             return jsonify({"error": "Invalid JSON data"}), 400
@@ -492,59 +693,22 @@ def sellStock():
         if not symbol or not quantity or quantity <= 0:
             return jsonify({"error": "Missing or invalid symbol or quantity"}), 400
 
-        docData = doc_data.to_dict()
-        ownedQuantity = docData.get("stocks", {}).get(symbol, 0)
-
-        if ownedQuantity < quantity:
-            return jsonify({"error": "Not enough stocks to sell"}), 400
-
-        response = fetchQuoteStocks(symbol)       
-        if not response or not response[0]:
-            return jsonify({"error": "Invalid stock symbol"}), 400
-
-        price = response[0]['price'] 
-        history = docData.get("history", {})
-        today_str = datetime.now().strftime("%Y-%m-%d")
-        yesterdayValueNotAdded = 0
+        # The quote and currency don't depend on the portfolio, fetch them in parallel
+        quote_future = EXECUTOR.submit(quotePrice, symbol)
+        currency_future = EXECUTOR.submit(getReferenceCurrency, db, owner_id)
 
-        if today_str not in history and history:
-            last_date_str = max(history.keys(), key=lambda d: datetime.strptime(d, "%Y-%m-%d"))
-            yesterdayValueNotAdded = history[last_date_str]
-
-        stocks = docData.get("stocks", {})
-        total_stocks_remaining = sum(stocks.values()) - quantity
+        doc = getPortfolioDocRef(db, owner_id)
+        error, sold_value = applySell(db.transaction(), doc, symbol, quantity, quote_future.result())
+        if error:
+            message, status = error
+            return jsonify({"error": message}), status
 
-        # Get current stocks and update manually
-        current_stocks = docData.get("stocks", {}).copy()
-        
-        if ownedQuantity == quantity:
-            # Remove the stock entirely
-            del current_stocks[symbol]
-            
-            if total_stocks_remaining == 0:
-                doc.update({
-                    "stocks": current_stocks,
-                    "cost": 0,
-                    f"history.{today_str}": 0
-                })
-            else:
-                doc.update({
-                    "stocks": current_stocks,
-                    "cost": firestore.Increment(price * quantity * -1),
-                    f"history.{today_str}": firestore.Increment(price * quantity * -1 + yesterdayValueNotAdded)
-                })
-        else:
-            # Decrease the quantity
-            current_stocks[symbol] = ownedQuantity - quantity
-            doc.update({
-                "stocks": current_stocks,
-                "cost": firestore.Increment(price * quantity * -1),
-                f"history.{today_str}": firestore.Increment(price * quantity * -1 + yesterdayValueNotAdded)
-            })
+        invalidateOwnerCache(owner_id)
+        reference_currency = currency_future.result()
 
         return jsonify({
             "message": "Stock sold successfully",
-            "price": convert_currency(price * quantity, 'USD', reference_currency),
+            "price": convert_currency(sold_value, 'USD', reference_currency),
             "currency": reference_currency
         })
     except Exception as e:
@@ -559,30 +723,6 @@ def buyStock():
     if not owner_id:
         return jsonify({"error": "Missing owner_id"}), 400
     
-    reference_currency = getReferenceCurrency(db, owner_id)
-    
-    doc = getPortfolioDocRef(db, owner_id)
-    
-    if not doc:
-        return jsonify({"error": "Could not get portfolio"}), 500
-
-    doc_data = doc.get()
-    if not doc_data.exists:
-        # Initialize portfolio if it doesn't exist
-        doc.set({
-            "stocks": {},
-            "cost": 0,
-            "history": {}
-        })
-        doc_data = doc.get()
-    
-    docData = doc_data.to_dict()
-
-    stocksNumber = len(docData.get("stocks", {}))
-
-    if stocksNumber >= 10:
-        return jsonify({"error": "Maximum number of different stocks reached (10)"}), 400
-    
     data = request.get_json()
     
     if not data:
@@ -597,41 +737,22 @@ def buyStock():
     if quantity <= 0:
         return jsonify({"error": "Quantity must be greater than 0"}), 400
     
-    response = fetchQuoteStocks(symbol)
+    # The quote and currency don't depend on the portfolio, fetch them in parallel
+    quote_future = EXECUTOR.submit(quotePrice, symbol)
+    currency_future = EXECUTOR.submit(getReferenceCurrency, db, owner_id)
     
-    if not response or not response[0]:
-        return jsonify({"error": "Wrong stock"}), 400
-
-    price = response[0]['price']
-    
-    history = docData.get("history", {})
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    
-    # Calculate the value to add to today's history
-    yesterdayValueNotAdded = 0
-    if today_str not in history:
-        if history:
-            # Get the most recent history value
-            last_date_str = max(history.keys(), key=lambda d: datetime.strptime(d, "%Y-%m-%d"))
-            yesterdayValueNotAdded = history[last_date_str]
-            print(f"Yesterday's value to add: {yesterdayValueNotAdded} from {last_date_str}")
-        else:
-            print("No history found, starting fresh")
-    else:
-        print(f"Today already has history value: {history[today_str]}")
+    doc = getPortfolioDocRef(db, owner_id)
     
-    stock_value = price * quantity
-    history_increment = stock_value + yesterdayValueNotAdded
+    if not doc:
+        return jsonify({"error": "Could not get portfolio"}), 500
 
-    # Get current stocks and update manually
-    current_stocks = docData.get("stocks", {}).copy()
-    current_stocks[symbol] = current_stocks.get(symbol, 0) + quantity
+    error, stock_value = applyBuy(db.transaction(), doc, symbol, quantity, quote_future.result())
+    if error:
+        message, status = error
+        return jsonify({"error": message}), status
 
-    doc.update({
-        "stocks": current_stocks,
-        "cost": firestore.Increment(stock_value),
-        f"history.{today_str}": firestore.Increment(history_increment)
-    })
+    invalidateOwnerCache(owner_id)
+    reference_currency = currency_future.result()
 
     converted_price = convert_currency(stock_value, 'USD', reference_currency)
 
@@ -6,7 +6,9 @@ bind = f"0.0.0.0:{port}"
 backlog = 2048
 
 workers = 5
-worker_class = 'sync'
+# Real OS threads: yfinance fetches through curl_cffi, a blocking C call gevent can't make cooperative
+worker_class = 'gthread'
+threads = 16
 worker_connections = 1000
 max_requests = 1000
 max_requests_jitter = 50
@@ -1,29 +1,89 @@
 import requests
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 import os
+import logging
 from cache import cache
+from flask import g, has_app_context
 from freecurrencyapi import Client
 import yfinance as yf
+import numpy as np
+import copy
+from types import MappingProxyType
+from functools import lru_cache, wraps
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from cachetools import TTLCache, cached
 
 load_dotenv(".env")
 
-API_URL = os.getenv('API_URL')
-API_HEADERS = {
+logger = logging.getLogger(__name__)
+
+# Get API config from environment, a missing API_URL fails at import rather than on every request
+API_URL = os.environ['API_URL']
+API_HEADERS = MappingProxyType({
     'X-API-KEY': os.getenv('API_KEY')
-}
+})
 
 # Initialize currency API client
 currency_api_key = os.getenv('CURRENCY_EXCHNAGE')
 currency_client = Client(currency_api_key)
 
-# Get API config from environment
-API_URL = os.getenv('API_URL')
-API_HEADERS = {
-    'X-API-KEY': os.getenv('API_KEY')
-}
+# Shared HTTP session so upstream calls reuse pooled keep-alive connections
+HTTP = requests.Session()
+HTTP.headers.update(API_HEADERS)
+_HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+)
+HTTP.mount('https://', _HTTP_ADAPTER)
+HTTP.mount('http://', _HTTP_ADAPTER)
+# (connect, read) seconds, so a stalled upstream can't hold a worker until the gunicorn timeout
+HTTP_TIMEOUT = (2, 5)
+
+# Pool for fanning out upstream calls, its tasks never wait on other pool tasks
+_FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=16)
+
+# The spark endpoint accepts at most this many symbols per call
+CHART_SYMBOLS_PER_REQUEST = 10
+_CHARTS_URL = f"{API_URL}/v8/finance/spark"
+
+def singleFlight(func):
+    """
+    Let concurrent calls with the same arguments wait on one running call instead of each
+    going upstream, so an expired cache entry is refilled once.
+    """
+    inflight = {}
+    lock = threading.Lock()
+
+    @wraps(func)
+    def wrapper(*args):
+        with lock:
+            future = inflight.get(args)
+            leader = future is None
+            if leader:
+                future = inflight[args] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with lock:
+                del inflight[args]
+    return wrapper
 
 # Fallback exchange rates (updated periodically as backup)
-FALLBACK_RATES = {
+FALLBACK_RATES = MappingProxyType({
     'EUR': 0.92,
     'GBP': 0.79,
     'JPY': 149.50,
@@ -44,10 +104,10 @@ FALLBACK_RATES = {
     'PLN': 3.95,
     'THB': 34.82,
     'MYR': 4.47
-}
+})
 
 # Store available currencies
-SUPPORTED_CURRENCIES = list(FALLBACK_RATES.keys())
+SUPPORTED_CURRENCIES = tuple(FALLBACK_RATES)
 
 # @cache.memoize()
 # def fetchQuoteStocks(symbols_str):
@@ -67,60 +127,193 @@ SUPPORTED_CURRENCIES = list(FALLBACK_RATES.keys())
 #     filtered_stocks = refineStocks(trendingStocksWithData)
 #     return filtered_stocks
 
-@cache.memoize()
-def fetchQuoteStocks(symbols_str):
-    print(f"\n--- fetchQuoteStocks called with: {symbols_str} ---")
-    
-    symbols = symbols_str.split(',')
-    filtered_stocks = []
+def _canonicalSymbols(symbols_str):
+    """
+    Cache key that treats the same set of symbols in any order, case or spacing as equal.
+    """
+    return ",".join(sorted({s.strip().upper() for s in symbols_str.split(',') if s.strip()}))
+
+def _requestedSymbols(symbols_str):
+    return [s.strip() for s in symbols_str.split(',') if s.strip()]
+
+# Quotes shared by all workers are cached per symbol, so overlapping symbol sets reuse them
+QUOTE_TIMEOUT = 60
+# Symbols Yahoo has no price for are remembered longer under a falsy marker (None means not cached)
+MISSING_QUOTE_TIMEOUT = 300
+_MISSING_QUOTE = False
+
+def _quoteCacheKey(symbol):
+    return f"quote/{symbol}"
+
+def _fetchQuote(symbol):
+    symbol = symbol.strip()
+    try:
+        ticker = yf.Ticker(symbol)
+        info = ticker.info
+        
+        stock_data = {
+            "symbol": symbol,
+            "shortName": info.get("shortName", symbol),
+            "price": info.get("currentPrice") or info.get("regularMarketPrice"),
+            "change": round(info.get("regularMarketChangePercent", 0), 2)
+        }
+        
+        if stock_data["price"]:
+            logger.debug("Fetched: %s", stock_data)
+            return stock_data
+        return _MISSING_QUOTE
+    except Exception as e:
+        logger.warning("Error fetching %s: %s", symbol, e)
+    return None
+
+# Symbol sets are cached per process for 20s on top of the shared per-symbol quotes
+@cached(TTLCache(maxsize=1024, ttl=20), lock=threading.Lock())
+@singleFlight
+def _fetchQuoteStocks(symbols_str):
+    logger.debug("fetchQuoteStocks called with: %s", symbols_str)
     
-    for symbol in symbols:
-        symbol = symbol.strip()
+    symbols = [symbol for symbol in symbols_str.split(',') if symbol]
+    if not symbols:
+        return []
+    # An unreachable cache backend only costs the cache, quotes are then fetched upstream
+    try:
+        quotes = dict(zip(symbols, cache.get_many(*map(_quoteCacheKey, symbols))))
+    except Exception as e:
+        logger.warning("Error reading cached quotes: %s", e)
+        quotes = dict.fromkeys(symbols)
+    missing = [symbol for symbol in symbols if quotes[symbol] is None]
+    if missing:
+        # Each .info is its own round-trip, so fetch them concurrently
+        fetched = dict(zip(missing, _FETCH_EXECUTOR.map(_fetchQuote, missing)))
         try:
-            ticker = yf.Ticker(symbol)
-            info = ticker.info
-            
-            stock_data = {
-                "symbol": symbol,
-                "shortName": info.get("shortName", symbol),
-                "price": info.get("currentPrice") or info.get("regularMarketPrice"),
-                "change": round(info.get("regularMarketChangePercent", 0), 2)
-            }
-            
-            if stock_data["price"]:
-                filtered_stocks.append(stock_data)
-                print(f"Fetched: {stock_data}")
+            cache.set_many({_quoteCacheKey(symbol): quote for symbol, quote in fetched.items() if quote}, timeout=QUOTE_TIMEOUT)
+            # Failed fetches are not remembered, a transient error shouldn't hide a holding for minutes
+            unknown = {_quoteCacheKey(symbol): _MISSING_QUOTE for symbol, quote in fetched.items() if quote is _MISSING_QUOTE}
+            if unknown:
+                cache.set_many(unknown, timeout=MISSING_QUOTE_TIMEOUT)
         except Exception as e:
-            print(f"Error fetching {symbol}: {e}")
-            continue
-    
-    return filtered_stocks
+            logger.warning("Error caching quotes: %s", e)
+        quotes.update(fetched)
+    return [quotes[symbol] for symbol in symbols if quotes[symbol]]
 
-@cache.memoize()
-def fetchCharts(symbols_str, interval, range):
-    querystring = {"symbols": symbols_str, "range": range, "interval": interval}
-    chartsResponse = requests.request("GET", f"{API_URL}/v8/finance/spark", headers=API_HEADERS, params=querystring)
+def fetchQuoteStocks(symbols_str):
+    key = _canonicalSymbols(symbols_str)
+    # Repeat fetches within a request see the same quotes even if the TTL lapses
+    if has_app_context():
+        request_quotes = g.setdefault("quotes", {})
+        if key not in request_quotes:
+            request_quotes[key] = _fetchQuoteStocks(key)
+        fetched = request_quotes[key]
+    else:
+        fetched = _fetchQuoteStocks(key)
+    # Cached quotes are shared, so hand out copies in the requested order and spelling
+    quotes = {quote["symbol"]: quote for quote in fetched}
+    return [{**quotes[symbol.upper()], "symbol": symbol} for symbol in _requestedSymbols(symbols_str) if symbol.upper() in quotes]
+
+@cached(TTLCache(maxsize=2048, ttl=60), lock=threading.Lock())
+@singleFlight
+@cache.memoize(timeout=300)
+def _fetchCharts(symbols_str, interval, range):
+    querystring = (("symbols", symbols_str), ("range", range), ("interval", interval))
+    chartsResponse = HTTP.get(_CHARTS_URL, params=querystring, timeout=HTTP_TIMEOUT)
     charts = chartsResponse.json()
     return charts
 
-def getIntervalFromRange(range):
-    if range == "1d":
-        return "1h"
-    elif range == "5d":
-        return "1d"
-    elif range == "1mo":
-        return "5d"
+def _chunkSymbols(symbols_str, size):
+    symbols = symbols_str.split(',')
+    return [",".join(symbols[i:i + size]) for i in range(0, len(symbols), size)]
+
+def fetchCharts(symbols_str, interval, range):
+    chunks = _chunkSymbols(_canonicalSymbols(symbols_str), CHART_SYMBOLS_PER_REQUEST)
+    if len(chunks) == 1:
+        charts = _fetchCharts(chunks[0], interval, range)
     else:
-        return "1d"
+        charts = {}
+        for chunk_charts in _FETCH_EXECUTOR.map(lambda chunk: _fetchCharts(chunk, interval, range), chunks):
+            charts.update(chunk_charts)
+    # Callers convert the series in place, so never hand out the cached dict
+    return {symbol: copy.deepcopy(charts[symbol.upper()]) for symbol in _requestedSymbols(symbols_str) if symbol.upper() in charts}
+
+# Chart interval for each supported range, anything else is charted daily
+_INTERVAL_MAP = {"1d": "1h", "5d": "1d", "1mo": "5d"}
+
+def getIntervalFromRange(range):
+    return _INTERVAL_MAP.get(range, "1d")
     
-def getPortfolioDoc(db, owner_id):
-    doc_ref = db.collection("portfolio").document(owner_id)
+def todayIso():
+    """
+    Today's UTC date as YYYY-MM-DD, computed once per request.
+    """
+    if "today" not in g:
+        g.today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    return g.today
+
+@cache.memoize(timeout=30, args_to_ignore=["db"])
+def _getDocCached(db, owner_id):
+    doc_ref = getPortfolioDocRef(db, owner_id)
     doc = doc_ref.get()
     if not doc.exists:
         return {}
     data = doc.to_dict()
     return data
 
+def getPortfolioDoc(db, owner_id):
+    """
+    Get the portfolio document, reading Firestore at most once per request.
+    Snapshots are shared across requests for 30 seconds.
+    """
+    docs = g.setdefault("portfolio_docs", {})
+    if owner_id not in docs:
+        docs[owner_id] = _getDocCached(db, owner_id)
+    return docs[owner_id]
+
+# Projections used by the endpoints that never look at the rest of the portfolio document
+HOLDINGS_FIELDS = ("stocks",)
+HISTORY_FIELDS = ("history",)
+
+@cache.memoize(timeout=30, args_to_ignore=["db"])
+def _getBundleCached(db, owner_id, fields=None):
+    portfolio_ref = getPortfolioDocRef(db, owner_id)
+    user_ref = db.collection("userInfo").document(owner_id)
+    # The mask applies to both documents, so the user's currency field rides along
+    field_paths = [*fields, "referenceCurrency"] if fields else None
+    # Both documents come back from one BatchGetDocuments call, in no particular order
+    snapshots = {snapshot.reference.path: snapshot for snapshot in db.get_all([portfolio_ref, user_ref], field_paths=field_paths)}
+    portfolio = snapshots[portfolio_ref.path]
+    user = snapshots[user_ref.path]
+    doc = portfolio.to_dict() if portfolio.exists else {}
+    reference_currency = user.to_dict().get("referenceCurrency") if user.exists else {}
+    return reference_currency, doc
+
+def getPortfolioBundle(db, owner_id, fields=None):
+    """
+    Get the reference currency and portfolio document with a single Firestore round-trip.
+    Pass a tuple of top-level fields to read only that part of the portfolio document.
+    The result is kept for the rest of the request and shared across requests for 30 seconds.
+    """
+    bundles = g.setdefault("portfolio_bundles", {})
+    if (owner_id, fields) not in bundles:
+        bundles[(owner_id, fields)] = _getBundleCached(db, owner_id, fields)
+        if fields is None:
+            g.setdefault("portfolio_docs", {})[owner_id] = bundles[(owner_id, fields)][1]
+    return bundles[(owner_id, fields)]
+
+def invalidatePortfolioDoc(db, owner_id):
+    """
+    Drop the cached portfolio snapshot after the document has been written.
+    """
+    g.get("portfolio_docs", {}).pop(owner_id, None)
+    for fields in (None, HOLDINGS_FIELDS, HISTORY_FIELDS):
+        g.get("portfolio_bundles", {}).pop((owner_id, fields), None)
+    # The write already happened, if the cache is unreachable the snapshots expire on their own
+    try:
+        cache.delete_memoized(_getDocCached, db, owner_id)
+        for fields in (None, HOLDINGS_FIELDS, HISTORY_FIELDS):
+            cache.delete_memoized(_getBundleCached, db, owner_id, fields)
+    except Exception as e:
+        logger.warning("Error invalidating cached portfolio %s: %s", owner_id, e)
+
+@cache.memoize(timeout=300, args_to_ignore=["db"])
 def getReferenceCurrency(db, owner_id):
     doc_ref = db.collection("userInfo").document(owner_id)
     doc = doc_ref.get()
@@ -129,6 +322,7 @@ def getReferenceCurrency(db, owner_id):
     data = doc.to_dict()
     return data.get("referenceCurrency")
 
+@lru_cache(maxsize=4096)
 def getPortfolioDocRef(db, owner_id):
     doc_ref = db.collection("portfolio").document(owner_id)
     return doc_ref
@@ -137,90 +331,198 @@ def getPortfolioStocksValuesUsingQuantity(symbols_str, stocksAndQuantities):
     def fetch_data(symbols_str):
         return fetchQuoteStocks(symbols_str)
     stocks = fetch_data(symbols_str)
-    response = []
-    for s in stocks:
-        stockToAppend = {"symbol": s['symbol'], "value": s['price'] * stocksAndQuantities[s['symbol']]}
-        response.append(stockToAppend)
-    return response
+    prices, quantities = holdingsArrays(stocks, stocksAndQuantities)
+    values = (prices * quantities).tolist()
+    return [{"symbol": s['symbol'], "value": value} for s, value in zip(stocks, values)]
+
+def getLastHistoryDate(docData):
+    """
+    Most recent history date, read from the denormalized last_history_date field when it is present.
+    """
+    history = docData.get("history", {})
+    last_date_str = docData.get("last_history_date")
+    if last_date_str in history:
+        return last_date_str
+    # History keys are ISO-8601 dates, so lexicographic order is chronological
+    return max(history) if history else None
+
+def getTotalShares(docData):
+    """
+    Number of shares held, read from the denormalized total_shares field when it is present.
+    """
+    total_shares = docData.get("total_shares")
+    if total_shares is not None:
+        return total_shares
+    return sum(docData.get("stocks", {}).values())
+
+def holdingsArrays(stock_data, stocksAndQuantities):
+    """
+    Parallel price and quantity arrays for the holdings priced in stock_data.
+    """
+    prices = np.fromiter((s['price'] for s in stock_data), dtype=np.float64, count=len(stock_data))
+    quantities = np.fromiter((stocksAndQuantities.get(s['symbol'], 0) for s in stock_data), dtype=np.float64, count=len(stock_data))
+    return prices, quantities
+
+def getHoldingsValue(stock_data, stocksAndQuantities):
+    """
+    Total value of the holdings priced in stock_data, as a single dot product.
+    """
+    prices, quantities = holdingsArrays(stock_data, stocksAndQuantities)
+    return float(prices @ quantities)
+
+# Rates are served from cache for an hour, then refreshed in the background while the
+# stale ones keep being served; only entries older than a day make a caller wait.
+# A failed refresh keeps the previous rates and is retried after RATES_RETRY_SECONDS.
+RATES_FRESH_SECONDS = 3600
+RATES_RETRY_SECONDS = 60
+RATES_MAX_AGE_SECONDS = 86400
+RATES_CACHE_KEY = 'exchange_rates/entry'
+_rates_refresh_lock = threading.Lock()
 
-@cache.cached(timeout=3600, key_prefix='exchange_rates')
 def get_exchange_rates():
     """
-    Get all exchange rates with USD as base currency using currencies endpoint.
-    Cached for 1 hour to reduce API calls.
+    Get all exchange rates with USD as base currency, stale-while-revalidate cached.
+    """
+    try:
+        entry = cache.get(RATES_CACHE_KEY)
+    except Exception as e:
+        logger.warning("Error reading cached exchange rates: %s", e)
+        entry = None
+    if entry is None:
+        return _refreshExchangeRates()
+    rates, fetched_at, refresh_at = entry
+    if time.time() > refresh_at and _rates_refresh_lock.acquire(blocking=False):
+        refresh = _FETCH_EXECUTOR.submit(_refreshExchangeRates, entry)
+        refresh.add_done_callback(lambda _: _rates_refresh_lock.release())
+    return rates
+
+def _refreshExchangeRates(previous=None):
+    """
+    Fetch the rates and cache them as (rates, fetched_at, refresh_at).
+    """
+    rates = _fetchExchangeRates()
+    now = time.time()
+    if rates is not None:
+        _storeExchangeRates((rates, now, now + RATES_FRESH_SECONDS), RATES_MAX_AGE_SECONDS)
+        return rates
+    if previous is None:
+        # Nothing to fall back on but the hardcoded table, hold it only until the next retry
+        logger.warning("Using fallback exchange rates")
+        _storeExchangeRates((FALLBACK_RATES, now, now + RATES_RETRY_SECONDS), RATES_RETRY_SECONDS)
+        return FALLBACK_RATES
+    rates, fetched_at, _ = previous
+    remaining = RATES_MAX_AGE_SECONDS - (now - fetched_at)
+    if remaining > 0:
+        _storeExchangeRates((rates, fetched_at, now + RATES_RETRY_SECONDS), remaining)
+    return rates
+
+def _storeExchangeRates(entry, timeout):
+    rates, fetched_at, refresh_at = entry
+    try:
+        # The read-only fallback mapping can't be pickled by the cache backends
+        cache.set(RATES_CACHE_KEY, (dict(rates), fetched_at, refresh_at), timeout=timeout)
+    except Exception as e:
+        logger.warning("Error caching exchange rates: %s", e)
+
+def _fetchExchangeRates():
+    """
+    Get all exchange rates with USD as base currency using the latest endpoint, None on failure.
     """
     try:
-        response = currency_client.currencies(currencies=SUPPORTED_CURRENCIES)
+        rates_response = currency_client.latest(base_currency='USD', currencies=list(SUPPORTED_CURRENCIES))  # the client only accepts a list
+        rates = rates_response.get('data', {}) if rates_response else {}
         
-        if response and 'data' in response:
-            rates_response = currency_client.latest(base_currency='USD', currencies=SUPPORTED_CURRENCIES)
-            rates = rates_response.get('data', {})
-            
-            if rates:
-                print("Successfully fetched exchange rates from API")
-                return rates
-            else:
-                print("Empty response from currency API, using fallback rates")
-                return FALLBACK_RATES.copy()
+        if rates:
+            logger.info("Successfully fetched exchange rates from API")
+            return rates
         else:
-            print("Invalid response from currency API, using fallback rates")
-            return FALLBACK_RATES.copy()
+            logger.warning("Empty response from currency API")
+            return None
     except Exception as e:
-        print(f"Error fetching exchange rates: {e}")
-        print("Using fallback exchange rates")
-        return FALLBACK_RATES.copy()
+        logger.warning("Error fetching exchange rates: %s", e)
+        return None
+
+def _normalizeCurrency(currency):
+    """
+    Uppercase currency code, USD when it is missing or blank.
+    """
+    if not currency or currency.strip() == '':
+        return 'USD'
+    return currency.strip().upper()
+
+def _crossRates(rates):
+    return _crossRateTable(tuple(sorted(rates.items())))
+
+@lru_cache(maxsize=8)
+def _crossRateTable(usd_rates):
+    """
+    Rate for every (from, to) currency pair, built once per set of USD based rates.
+    Currencies missing from the live rates use their fallback rate.
+    """
+    merged = {**FALLBACK_RATES, **dict(usd_rates), 'USD': 1.0}
+    return {(a, b): merged[b] / merged[a] for a in merged for b in merged}
 
 def get_exchange_rate(from_currency='USD', to_currency='USD'):
     """
     Get exchange rate from one currency to another.
     """
-    if not to_currency or to_currency.strip() == '':
-        to_currency = 'USD'
-    if not from_currency or from_currency.strip() == '':
-        from_currency = 'USD'
-    
-    # Normalize to uppercase
-    to_currency = to_currency.strip().upper()
-    from_currency = from_currency.strip().upper()
+    to_currency = _normalizeCurrency(to_currency)
+    from_currency = _normalizeCurrency(from_currency)
     
     if from_currency == to_currency:
         return 1.0
     
     try:
         rates = get_exchange_rates()
+        rate = _crossRates(rates).get((from_currency, to_currency))
         
-        if to_currency not in rates:
-            print(f"Currency {to_currency} not found in rates, checking fallback")
-            if to_currency in FALLBACK_RATES:
-                return FALLBACK_RATES[to_currency]
-            else:
-                print(f"Currency {to_currency} not supported, returning 1.0")
-                return 1.0
+        if rate is None:
+            logger.warning("Currency pair %s/%s not supported, returning 1.0", from_currency, to_currency)
+            return 1.0
         
-        return rates.get(to_currency, 1.0)
+        return rate
     except Exception as e:
-        print(f"Error getting exchange rate: {e}")
-        return FALLBACK_RATES.get(to_currency, 1.0)
+        logger.warning("Error getting exchange rate: %s", e)
+        return _crossRates(FALLBACK_RATES).get((from_currency, to_currency), 1.0)
+
+# Short enough that a pair resolved from the fallback table doesn't outlive the next rates retry
+@cached(TTLCache(maxsize=256, ttl=RATES_RETRY_SECONDS), lock=threading.Lock())
+def _cachedFxRate(from_currency, to_currency):
+    return get_exchange_rate(from_currency, to_currency)
+
+def getFxRate(from_currency='USD', to_currency='USD'):
+    """
+    Get a cached exchange rate so whole series can be converted with one multiply.
+    Codes are normalized first so every spelling of a pair shares one cache entry.
+    """
+    return _cachedFxRate(_normalizeCurrency(from_currency), _normalizeCurrency(to_currency))
+
+def convertMany(values, from_currency='USD', to_currency='USD'):
+    """
+    Convert a sequence of amounts with one rate lookup and a single vectorized multiply.
+    Missing values are kept as None.
+    """
+    amounts = np.asarray(list(values), dtype=np.float64)
+    converted = np.round(amounts * getFxRate(from_currency, to_currency), 2)
+    missing = np.isnan(amounts)
+    if missing.any():
+        return np.where(missing, None, converted).tolist()
+    return converted.tolist()
 
 def convert_currency(amount, from_currency='USD', to_currency='USD'):
     """
     Convert amount from one currency to another.
     Returns original amount if conversion fails.
     """
-    if not to_currency or to_currency.strip() == '':
-        to_currency = 'USD'
-    if not from_currency or from_currency.strip() == '':
-        from_currency = 'USD'
-    
-    to_currency = to_currency.strip().upper()
-    from_currency = from_currency.strip().upper()
+    to_currency = _normalizeCurrency(to_currency)
+    from_currency = _normalizeCurrency(from_currency)
     
     if from_currency == to_currency or amount == 0:
         return round(amount, 2)
     
     try:
-        rate = get_exchange_rate(from_currency, to_currency)
+        rate = _cachedFxRate(from_currency, to_currency)
         return round(amount * rate, 2)
     except Exception as e:
-        print(f"Error converting currency: {e}")
+        logger.warning("Error converting currency: %s", e)
         return round(amount, 2)